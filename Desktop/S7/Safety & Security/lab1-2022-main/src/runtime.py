@@ -10,46 +10,195 @@ from tinyscript_util import (
 	state_from_z3_model
 )
 from interpreter import exc
+from dataclasses import fields
+from functools import lru_cache, reduce
+from pathlib import Path
+import multiprocessing
 import tinyscript as tn
 import z3
 
 # Global variables
 STEPS_LEFT = "#steps_left"
+# Parameters for the SMT core on the integer arithmetic queries the
+# instrumented programs produce, which are dense with nested Implies
+SOLVER_PARAMS = {
+	'smt.relevancy': 2,
+	'smt.arith.solver': 6,
+	'smt.phase_selection': 0,
+}
+# Shared by every decrement; AST nodes are never mutated after construction
+_STEPS_VAR = tn.Var(STEPS_LEFT)
+_ONE = tn.Const(1)
 
-def ins_to_add():
-	decrementSteps = tn.Asgn(STEPS_LEFT, tn.Difference(tn.Var(STEPS_LEFT), tn.Const(1)))
+@lru_cache(maxsize=None)
+def ins_to_add(k: int=1):
+	decrementSteps = tn.Asgn(STEPS_LEFT, tn.Difference(_STEPS_VAR, _ONE if k == 1 else tn.Const(k)))
 	return decrementSteps
 
+# Hash-consing table for instrumented programs, so that structurally
+# equal subprograms built by add_instrumentation are the same object.
+# Children are interned before their parents and compared by id.
+_nodes: dict[tuple, tn.Prog] = {}
+
+def make_node(cls: type, *args) -> tn.Prog:
+	key = (cls,) + tuple(id(a) if isinstance(a, tn.Prog) else repr(a) for a in args)
+	if key not in _nodes:
+		_nodes[key] = cls(*args)
+	return _nodes[key]
+
+def share(alpha: tn.Prog) -> tn.Prog:
+	return make_node(type(alpha), *(
+		share(a) if isinstance(a, tn.Prog) else a 
+		for a in (getattr(alpha, f.name) for f in fields(alpha))))
+
+def flatten_seq(alpha: tn.Prog) -> list[tn.Prog]:
+	match alpha:
+		case tn.Seq(alpha_p, beta_p):
+			return flatten_seq(alpha_p) + flatten_seq(beta_p)
+	return [alpha]
+
+def ins_if(alpha: tn.If, step_bound: Optional[int]) -> tn.Prog:
+	if static_steps(alpha) is not None:
+		return ins_block(alpha, step_bound)
+	ins_alpha = add_instrumentation(alpha.alpha, step_bound)
+	ins_beta = add_instrumentation(alpha.beta, step_bound)
+	return make_node(tn.If, alpha.q, ins_alpha, ins_beta)
+
+def ins_while(alpha: tn.While, step_bound: Optional[int]) -> tn.Prog:
+	ins_alpha = add_instrumentation(alpha.alpha, step_bound)
+	return make_node(tn.While, alpha.q, ins_alpha)
+
+def ins_block(alpha: tn.Prog, step_bound: Optional[int]) -> tn.Prog:
+	# code that takes a fixed number of steps: charge each maximal
+	# run of such statements with a single decrement ahead of the
+	# run, and leave the statements themselves uninstrumented
+	stmts = []
+	run = []
+	steps = 0
+	for beta in flatten_seq(alpha) + [None]:
+		k = None if beta is None else static_steps(beta)
+		if k is not None:
+			run.append(share(beta))
+			steps += k
+			continue
+		if len(run) > 0:
+			stmts += [ins_to_add(steps)] + run
+			run = []
+			steps = 0
+		if beta is not None:
+			stmts.append(add_instrumentation(beta, step_bound))
+	return reduce(lambda rest, beta: make_node(tn.Seq, beta, rest), reversed(stmts[:-1]), stmts[-1])
+
+INS_HANDLERS = {
+	tn.Asgn: ins_block,
+	tn.Skip: ins_block,
+	tn.Output: ins_block,
+	tn.Abort: ins_block,
+	tn.Seq: ins_block,
+	tn.If: ins_if,
+	tn.While: ins_while,
+}
+
 def add_instrumentation(alpha: tn.Prog, step_bound: Optional[int]=None) -> tn.Prog:
+	handler = INS_HANDLERS.get(type(alpha))
+	if handler is not None:
+		return handler(alpha, step_bound)
+	
+	# should not ever get here
+	return alpha
+
+def count_steps(alpha: tn.Prog) -> tuple[int, Optional[int]]:
+	"""
+	Bounds the number of steps taken by any terminating trace of
+	`alpha`, not counting updates to the step counter itself.
+	
+	Args:
+	    alpha (tn.Prog): Program to count steps in
+	
+	Returns:
+	    tuple[int, Optional[int]]: The minimum and maximum step count;
+	    	the maximum is `None` if `alpha` contains a loop.
+	"""
 	match alpha:
 		case tn.Asgn(name, e):
-			return tn.Seq(ins_to_add(), alpha)
+			return (0, 0) if name == STEPS_LEFT else (1, 1)
 
-		case tn.Skip():
-			return tn.Seq(ins_to_add(), alpha)
+		case tn.Skip() | tn.Output() | tn.Abort():
+			return (1, 1)
 
-		case tn.Output(e):
-			return tn.Seq(ins_to_add(), alpha)
+		case tn.Seq(alpha_p, beta_p):
+			min_a, max_a = count_steps(alpha_p)
+			min_b, max_b = count_steps(beta_p)
+			return (min_a + min_b, 
+				None if max_a is None or max_b is None else max_a + max_b)
+
+		case tn.If(p, alpha_p, beta_p):
+			min_a, max_a = count_steps(alpha_p)
+			min_b, max_b = count_steps(beta_p)
+			return (min(min_a, min_b), 
+				None if max_a is None or max_b is None else max(max_a, max_b))
 
-		case tn.Abort():
-			return tn.Seq(ins_to_add(), alpha)
+		case tn.While(q, alpha_p):
+			return (0, None)
 
+	raise TypeError(
+		f"count_steps got {type(alpha)} ({alpha}), not Prog"
+	)
+
+def static_steps(alpha: tn.Prog) -> Optional[int]:
+	"""
+	Returns the number of steps every terminating trace of `alpha`
+	takes, or `None` if it depends on the path taken.
+	"""
+	min_steps, max_steps = count_steps(alpha)
+	return min_steps if min_steps == max_steps else None
+
+def loop_limits(
+	alpha: tn.Prog, 
+	step_bound: int, 
+	consumed: int=0,
+	limits: Optional[dict[int, int]]=None
+) -> dict[int, int]:
+	"""
+	Finds, for each loop in `alpha`, a number of iterations after
+	which every trace has taken more than `step_bound` steps, so that
+	unrolling the loop any further cannot change the result of the
+	check. Iterations of a loop take at least as many steps as the
+	fewest its body can take, and a loop is reached only after the
+	fewest steps any path to it can take.
+	
+	Args:
+	    alpha (tn.Prog): Program to analyze
+	    step_bound (int): Step bound to check
+	    consumed (int, optional): Lower bound on steps taken
+	    	before `alpha` runs
+	    limits (dict[int, int], optional): Limits found so far
+	
+	Returns:
+	    dict[int, int]: Iteration limits, keyed on the `id` of each
+	    	loop whose body always takes at least one step.
+	"""
+	if limits is None:
+		limits = {}
+	match alpha:
 		case tn.Seq(alpha_p, beta_p):
-			ins_alpha = add_instrumentation(alpha_p, step_bound)
-			ins_beta = add_instrumentation(beta_p, step_bound)
-			return tn.Seq(ins_alpha, ins_beta)
+			loop_limits(alpha_p, step_bound, consumed, limits)
+			consumed += count_steps(alpha_p)[0]
+			loop_limits(beta_p, step_bound, consumed, limits)
 
 		case tn.If(p, alpha_p, beta_p):
-			ins_alpha = add_instrumentation(alpha_p, step_bound)
-			ins_beta = add_instrumentation(beta_p, step_bound)
-			return tn.If(p, ins_alpha, ins_beta)
+			loop_limits(alpha_p, step_bound, consumed, limits)
+			loop_limits(beta_p, step_bound, consumed, limits)
 
 		case tn.While(q, alpha_p):
-			ins_alpha = add_instrumentation(alpha_p, step_bound)
-			return tn.While(q, ins_alpha)
-	
-	# should not ever get here
-	return alpha
+			per_iteration = count_steps(alpha_p)[0]
+			if per_iteration > 0:
+				# the same node may be reached at several points of a
+				# hash-consed program; keep the most conservative limit
+				limit = (step_bound - consumed) // per_iteration + 1
+				limits[id(alpha)] = max(limit, limits.get(id(alpha), limit))
+			loop_limits(alpha_p, step_bound, consumed, limits)
+	return limits
 
 def instrument(alpha: tn.Prog, step_bound: Optional[int]=None) -> tn.Prog:
 	"""
@@ -69,6 +218,7 @@ def instrument(alpha: tn.Prog, step_bound: Optional[int]=None) -> tn.Prog:
 	    	assignment, output, abort, or skip statement.
 	"""
 	initializeStepsLeft = tn.Asgn(STEPS_LEFT, tn.Const(step_bound))
+	_nodes.clear()
 	ins_alpha = add_instrumentation(alpha, step_bound)
 	return tn.Seq(initializeStepsLeft, ins_alpha)
 
@@ -82,24 +232,47 @@ def instrument(alpha: tn.Prog, step_bound: Optional[int]=None) -> tn.Prog:
 # program = tn.Seq(tn.Seq(initializeX, initializeY), whileLoop)
 # print("PROGRAM", program)
 
+def make_solver() -> z3.Solver:
+	"""
+	Builds a solver that preprocesses queries before handing them to
+	the SMT core. Chained `#steps_left` assignments leave long runs of
+	integer equalities in the weakest precondition, most of which are
+	eliminated by value propagation and equation solving.
+	
+	Returns:
+	    z3.Solver: Solver backed by the preprocessing tactic
+	"""
+	t = z3.Then(
+		z3.Tactic('simplify'),
+		z3.Tactic('propagate-values'),
+		z3.Repeat(z3.Tactic('solve-eqs')),
+		z3.Tactic('ctx-solver-simplify'),
+		z3.Tactic('smt'))
+	return t.solver()
+
 def symbolic_check(
 	alpha: tn.Prog, 
 	step_bound: int,
 	max_depth: int=3,
-	timeout: int=1) -> Result:
+	timeout: float=0.25,
+	solver: Optional[z3.Solver]=None) -> Result:
 	"""
 	Uses the box modality and a satisfiability solver to determine
 	whether there are any traces that execute more than `step_bound`
 	steps. A step occurs when the program executes an assignment, 
 	output, abort, or skip statement. This function only considers 
 	traces generated after unrolling loops up to `max_depth` times, 
-	and will terminate the solver after `timeout` seconds.
+	and will terminate the solver after `timeout` seconds. Callers that
+	need a definite answer can retry `Result.Unknown` with a longer
+	timeout, as `check_file` does.
 	
 	Args:
 	    alpha (tn.Prog): Program to check
 	    step_bound (int): Step bound to check
 	    max_depth (int, optional): Loop unrolling depth
-	    timeout (int, optional): Solver timeout, in seconds
+	    timeout (float, optional): Solver timeout, in seconds
+	    solver (z3.Solver, optional): Solver to reuse across checks;
+	    	if `None`, a fresh one from `make_solver` is used
 	
 	Returns:
 	    Result: The status of the check, one of three values:
@@ -119,11 +292,34 @@ def symbolic_check(
 	    	  not return a state that caused the interpreter to execute
 	    	  at least `step_bound` steps.
 	"""
+	# Loop-free programs need no unrolling, so the step count of every
+	# path is known syntactically. The solver is only needed when the
+	# bound falls between the shortest and longest path, since the
+	# guards decide whether a long enough path is feasible.
+	min_steps, max_steps = count_steps(alpha)
+	if max_steps is not None and max_depth >= 1:
+		if max_steps <= step_bound:
+			return Result.Satisfies
+		if min_steps > step_bound:
+			return Result.Violates
+
 	alpha_p = instrument(alpha, step_bound)
+	# box substitutes the constant bound assigned at the start of alpha_p
+	# for #steps_left, so the counter arithmetic is folded away and the
+	# query only mentions the program's own (unbounded) variables
 	postcondition = tn.LtF(tn.Const(-1), tn.Var(STEPS_LEFT))
-	weakest_pre = box(alpha_p, fmla_enc(postcondition), max_depth=max_depth, depth_exceed_strict=True)
+	weakest_pre = box(
+		alpha_p, 
+		fmla_enc(postcondition), 
+		max_depth=max_depth, 
+		depth_exceed_strict=True,
+		unroll_limits=loop_limits(alpha_p, step_bound))
 
-	res, model = check_sat([z3.Not(weakest_pre)], timeout=timeout)
+	res, model = check_sat(
+		[z3.Not(weakest_pre)], 
+		timeout=timeout, 
+		solver=make_solver() if solver is None else solver,
+		params=SOLVER_PARAMS)
 
 	if res == z3.unsat:
 		return Result.Satisfies
@@ -134,13 +330,40 @@ def symbolic_check(
 	# 	if final_state[0].variables[VIOLATED] == 1:
 	# 		return Result.Violates
 	# return Result.Unknown
-	return Result.Violates
+	if res == z3.sat:
+		return Result.Violates
+	return Result.Unknown
+
+
+# Per-process solver for check_file, created by init_worker
+worker_solver: Optional[z3.Solver] = None
 
+def init_worker():
+	global worker_solver
+	worker_solver = make_solver()
+
+def check_file(
+	test_file: Path, 
+	step_bound: int=100,
+	timeouts: tuple[float, ...]=(0.25, 1, 4)
+) -> Result:
+	"""
+	Parses a test file and checks it against `step_bound`, reusing
+	the solver of the current worker process. A check that comes back
+	`Result.Unknown` is retried with each of the longer `timeouts`.
+	"""
+	from parser import parse
+	with test_file.open() as f:
+		prog = parse(f.read())
+	for timeout in timeouts:
+		res = symbolic_check(prog, step_bound, timeout=timeout, solver=worker_solver)
+		if res != Result.Unknown:
+			break
+	return res
 
 if __name__ == "__main__":
 	from parser import parse, fmla_parse
 	import sys
-	from pathlib import Path
 
 	# TEST_DIR = Path('.') / 'tests'
 	TEST_DIR = Path('.') / 'test'
@@ -152,30 +375,22 @@ if __name__ == "__main__":
 	violate = 0
 	unknown = 0
 
-	for test_file in list(TEST_DIR.iterdir()):
-		if not str(test_file).endswith('tinyscript'):
-			continue
-		with test_file.open() as f:
-			prog = parse(f.read())
-# test
-			alpha_p = instrument(prog, 100)
-			print("INSPROGRAM:\n", stringify(alpha_p))
-# test
-
-
-
-			res = symbolic_check(prog, 100)
-			print((
-				f"{test_file} result:" 
-				f"{res}"))
-
-			match res:
-				case Result.Satisfies:
-					passed += 1
-				case Result.Violates:
-					violate += 1
-				case Result.Unknown:
-					unknown += 1
+	test_files = [p for p in TEST_DIR.iterdir() if str(p).endswith('tinyscript')]
+	with multiprocessing.Pool(initializer=init_worker) as pool:
+		results = pool.map(check_file, test_files)
+
+	for test_file, res in zip(test_files, results):
+		print((
+			f"{test_file} result:" 
+			f"{res}"))
+
+		match res:
+			case Result.Satisfies:
+				passed += 1
+			case Result.Violates:
+				violate += 1
+			case Result.Unknown:
+				unknown += 1
 
 	print(f"\n{passed=}, {violate=}, {unknown=}")
 
@@ -1,20 +1,251 @@
 from tinyscript_util import (
     fmla_enc,
-    simplify,
-    term_enc
+    term_enc,
+    try_eval
 )
 from enum import Enum
+from typing import Optional
 import tinyscript as tn
 import z3
 
 Result = Enum('Result', ['Satisfies', 'Violates', 'Unknown'])
-        
-@simplify
+
+# Built once per process and reused by every call to `box`
+_SIMPLIFY_TACTIC = z3.Then(z3.Tactic('propagate-values'), z3.Tactic('simplify'))
+
+def _simplify_goal(func):
+    """
+    Decorator to simplify functions returning z3 formulas by running
+    `_SIMPLIFY_TACTIC` over a goal holding the result
+    """
+    def simplifyInner(*args, **kwargs):
+        goal = z3.Goal()
+        goal.add(func(*args, **kwargs))
+        return _SIMPLIFY_TACTIC(goal).as_expr()
+    return simplifyInner
+
+Key = tuple[int, int, int]
+Frame = tuple[tn.Prog, z3.BoolRef, int, Key]
+
+# Results of `box` on subproblems, keyed on ids rather than on
+# (unhashable) program nodes. The lookup tables hold strong references
+# so that no id is recycled while the cache is live; `box` clears them.
+_cache: dict[Key, z3.BoolRef] = {}
+_progs: dict[int, tn.Prog] = {}
+_posts: dict[int, z3.BoolRef] = {}
+_unrolled: dict[int, tn.Prog] = {}
+_loops: dict[int, tuple[tn.While, int]] = {}
+_prefixes: dict[int, tuple[list[tuple[z3.ArithRef, z3.ArithRef]], Optional[tn.Prog]]] = {}
+# z3 encodings of each If guard and of the substitution pair of each
+# Asgn node, stored next to the node they were computed from.
+_encodings: dict[int, tuple[tn.Token, tuple[z3.ExprRef, z3.ExprRef]]] = {}
+
+def _unroll(alpha: tn.While) -> tn.Prog:
+    """
+    Build (once per loop node) the program that the loop axiom
+    rewrites `alpha` into. The loop inside the unrolling is a copy of
+    `alpha` recorded in `_loops` with the original loop node and the
+    number of iterations unrolled so far.
+    """
+    if id(alpha) not in _unrolled:
+        origin, iteration = _loops.get(id(alpha), (alpha, 0))
+        succ = tn.While(alpha.q, alpha.alpha)
+        _loops[id(succ)] = (origin, iteration+1)
+        _unrolled[id(alpha)] = tn.If(alpha.q,
+                                    tn.Seq(alpha.alpha, succ),
+                                    tn.Asgn('x', tn.Var('x')))
+    return _unrolled[id(alpha)]
+
+def _guards(alpha: tn.If) -> tuple[z3.BoolRef, z3.BoolRef]:
+    """
+    Encode the guard of `alpha` and its negation, once per guard node.
+    """
+    if id(alpha.q) not in _encodings:
+        _encodings[id(alpha.q)] = (alpha.q, (fmla_enc(alpha.q), fmla_enc(tn.NotF(alpha.q))))
+    return _encodings[id(alpha.q)][1]
+
+def _assignment(alpha: tn.Asgn) -> tuple[z3.ArithRef, z3.ArithRef]:
+    """
+    Encode the substitution pair of `alpha`, once per Asgn node.
+    """
+    if id(alpha) not in _encodings:
+        _encodings[id(alpha)] = (alpha, (term_enc(tn.Var(alpha.name)), term_enc(alpha.exp)))
+    return _encodings[id(alpha)][1]
+
+def _assignment_prefix(
+    alpha: tn.Prog
+) -> tuple[list[tuple[z3.ArithRef, z3.ArithRef]], Optional[tn.Prog]]:
+    """
+    Split `alpha` into its longest prefix of atomic statements and
+    compose the prefix's assignments into one simultaneous substitution,
+    mapping each assigned variable to its final value in terms of the
+    initial state. Returns the substitution pairs and the remaining
+    program, or `None` if nothing remains.
+    """
+    if id(alpha) in _prefixes:
+        return _prefixes[id(alpha)]
+    start = alpha
+    values = {}
+    while alpha is not None:
+        match alpha:
+            case tn.Seq(beta, rest):
+                pass
+            case _:
+                beta, rest = alpha, None
+        match beta:
+            case tn.Asgn(name, e):
+                var, value = _assignment(beta)
+                if len(values) > 0:
+                    value = z3.simplify(z3.substitute(value, list(values.values())))
+                values[name] = (var, value)
+            case tn.Skip() | tn.Output() | tn.Abort():
+                pass
+            case _:
+                break
+        alpha = rest
+    _prefixes[id(start)] = (list(values.values()), alpha)
+    return _prefixes[id(start)]
+
+def _key(alpha: tn.Prog, postcondition: z3.BoolRef, max_depth: int) -> Key:
+    _progs[id(alpha)] = alpha
+    _posts[postcondition.get_id()] = postcondition
+    return (id(alpha), postcondition.get_id(), max_depth)
+
+def _lookup(
+    alpha: tn.Prog,
+    postcondition: z3.BoolRef,
+    max_depth: int,
+    pending: list[Frame]
+) -> Optional[z3.BoolRef]:
+    """
+    Fetch the cached result of a subproblem, or schedule it in
+    `pending` and return `None` if it has not been computed yet.
+    """
+    key = _key(alpha, postcondition, max_depth)
+    result = _cache.get(key)
+    if result is None:
+        pending.append((alpha, postcondition, max_depth, key))
+    return result
+
+# Each axiom below takes the arguments of `_step` and returns the
+# same way: `None` after scheduling any subproblems that are missing.
+
+# [skip] P <--> [output = e] P <--> [abort] P <--> P
+def _box_postcondition(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending):
+    return postcondition
+
+# [x := e] P(x) <--> P(e)
+def _box_asgn(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending):
+    return z3.substitute(postcondition, [_assignment(alpha)])
+
+# [x1 := e1; ...; xn := en; beta] P <--> ([beta] P)(v1, ..., vn),
+# where vi is ei with v1, ..., v(i-1) substituted for x1, ..., x(i-1),
+# and otherwise [alpha; beta] P <--> [alpha]([beta] P)
+def _box_seq(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending):
+    pairs, rest = _assignment_prefix(alpha)
+    if len(pairs) > 1:
+        if rest is not None:
+            postcondition = _lookup(rest, postcondition, max_depth, pending)
+            if postcondition is None:
+                return None
+        return z3.substitute(postcondition, pairs)
+    beta_post = _lookup(alpha.beta, postcondition, max_depth, pending)
+    if beta_post is None:
+        return None
+    return _lookup(alpha.alpha, beta_post, max_depth, pending)
+
+# [If(Q) alpha else beta] P <--> (Q -> [alpha] P) ^ (~Q -> [beta] P),
+# which is just [alpha] P or [beta] P if Q is constant
+def _box_if(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending):
+    match try_eval(alpha.q):
+        case True:
+            return _lookup(alpha.alpha, postcondition, max_depth, pending)
+        case False:
+            return _lookup(alpha.beta, postcondition, max_depth, pending)
+    alpha_post = _lookup(alpha.alpha, postcondition, max_depth, pending)
+    beta_post = _lookup(alpha.beta, postcondition, max_depth, pending)
+    if alpha_post is None or beta_post is None:
+        return None
+    enc_q, enc_not_q = _guards(alpha)
+    return z3.And(z3.Implies(enc_q, alpha_post),
+                        z3.Implies(enc_not_q, beta_post))
+
+# [while(Q) alpha] P <--> [if(Q) { alpha; while(Q) alpha } else { assert(True) }] P
+def _box_while(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending):
+    if unroll_limits is not None:
+        origin, iteration = _loops.get(id(alpha), (alpha, 0))
+        if iteration >= unroll_limits.get(id(origin), iteration+1):
+            return z3.BoolVal(False) if depth_exceed_strict else z3.BoolVal(True)
+    return _lookup(_unroll(alpha), postcondition, max_depth-1, pending)
+
+_STEP_HANDLERS = {
+    tn.Skip: _box_postcondition,
+    tn.Asgn: _box_asgn,
+    tn.Seq: _box_seq,
+    tn.If: _box_if,
+    tn.While: _box_while,
+    tn.Output: _box_postcondition,
+    tn.Abort: _box_postcondition,
+}
+
+def _step(
+    alpha: tn.Prog,
+    postcondition: z3.BoolRef,
+    max_depth: int,
+    depth_exceed_strict: bool,
+    unroll_limits: Optional[dict[int, int]],
+    pending: list[Frame]
+) -> Optional[z3.BoolRef]:
+    """
+    Apply one axiom at the root of `alpha`. Returns `None` after
+    scheduling in `pending` any subproblems whose results are missing.
+    """
+    if max_depth < 1:
+        return z3.BoolVal(False) if depth_exceed_strict else z3.BoolVal(True)
+
+    handler = _STEP_HANDLERS.get(type(alpha))
+    if handler is None:
+        raise TypeError(
+            f"box got {type(alpha)} ({alpha}), not Prog"
+        )
+    return handler(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending)
+
+def _box_of(
+    alpha: tn.Prog,
+    postcondition: z3.BoolRef,
+    max_depth: int,
+    depth_exceed_strict: bool,
+    unroll_limits: Optional[dict[int, int]]
+) -> z3.BoolRef:
+    """
+    Compute `box` with an explicit stack of subproblems in place of
+    recursion. A frame stays on the stack until every subproblem it
+    depends on is in the cache, so each is solved at most once. Frames
+    carry their cache key, which is computed once when they are pushed.
+    """
+    root = _key(alpha, postcondition, max_depth)
+    stack = [(alpha, postcondition, max_depth, root)]
+    while len(stack) > 0:
+        alpha, postcondition, max_depth, key = stack[-1]
+        if key in _cache:
+            stack.pop()
+            continue
+        pending = []
+        result = _step(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits, pending)
+        if result is None:
+            stack.extend(pending)
+        else:
+            _cache[key] = z3.simplify(result)
+            stack.pop()
+    return _cache[root]
+
+@_simplify_goal
 def box(
     alpha: tn.Prog,
     postcondition: z3.BoolRef,
     max_depth: int=10,
-    depth_exceed_strict: bool=True
+    depth_exceed_strict: bool=True,
+    unroll_limits: Optional[dict[int, int]]=None
 ) -> z3.BoolRef:
     """
     Apply the axioms of dynamic logic to convert a box formula to
@@ -32,6 +263,10 @@ def box(
         depth_exceed_strict (bool, optional): Flags strict
             verification conditions for traces that exceed the
             loop recursion bound; defaults to `True`.
+        unroll_limits (dict[int, int], optional): Maps the `id` of
+            a loop in `alpha` to a number of iterations after which
+            it stops being unrolled, as if `max_depth` were reached;
+            defaults to `None`, i.e., only `max_depth` applies.
     
     Returns:
         z3.BoolRef: Result of applying axioms
@@ -39,42 +274,11 @@ def box(
     Raises:
         TypeError: `alpha` isn't a program
     """
-    if max_depth < 1:
-        return z3.BoolVal(False) if depth_exceed_strict else z3.BoolVal(True)
-
-    match alpha:
-        case tn.Skip():
-            return postcondition
-
-        # [x := e] P(x) <--> P(e)
-        case tn.Asgn(name, e):
-            return z3.substitute(postcondition, [(term_enc(tn.Var(name)), term_enc(e))])
-
-        # [alpha; beta] P <--> [alpha]([beta] P)
-        case tn.Seq(alpha_p, beta_p):
-            return box(alpha_p, 
-                                box(beta_p, postcondition, max_depth), 
-                                max_depth)
-
-        # [If(Q) alpha else beta] P <--> (Q -> [alpha] P) ^ (~Q -> [beta] P)
-        case tn.If(q, alpha_p, beta_p):
-            return z3.And(z3.Implies(fmla_enc(q), box(alpha_p, postcondition, max_depth)),
-                                z3.Implies(fmla_enc(tn.NotF(q)), box(beta_p, postcondition, max_depth)))
-
-        # [while(Q) alpha] P <--> [if(Q) { alpha; while(Q) alpha } else { assert(True) }] P
-        case tn.While(q, alpha_p):
-            return box(tn.If(q, 
-                            tn.Seq(alpha_p, alpha),
-                            tn.Asgn('x', tn.Var('x'))), 
-                        postcondition, max_depth-1)
-        # [output = e] P
-        case tn.Output(e):
-            return postcondition
-
-        case tn.Abort():
-            return postcondition
-
-        case _:
-            raise TypeError(
-                f"box got {type(alpha)} ({alpha}), not Prog"
-            )
+    _cache.clear()
+    _progs.clear()
+    _posts.clear()
+    _unrolled.clear()
+    _loops.clear()
+    _prefixes.clear()
+    _encodings.clear()
+    return _box_of(alpha, postcondition, max_depth, depth_exceed_strict, unroll_limits)
@@ -24,7 +24,9 @@ def simplify(func):
 
 def check_sat(
 	ps: list[z3.BoolRef],
-	timeout: int=None
+	timeout: int=None,
+	solver: Optional[z3.Solver]=None,
+	params: Optional[dict]=None
 ) -> tuple[z3.CheckSatResult, Optional[z3.ModelRef]]:
 	"""
 	Checks a list of formulas for satisfiability, with
@@ -34,6 +36,12 @@ def check_sat(
 	    ps (list[z3.BoolRef]): Formulas to check
 	    timeout (int, optional): Timeout in seconds, or `None`
 	    	for no timeout. Defaults to `None`.
+	    solver (z3.Solver, optional): Solver to reuse across calls.
+	    	The formulas are checked in a fresh scope that is popped
+	    	before returning, so the solver is left as it was found.
+	    	If `None`, a new solver is created. Defaults to `None`.
+	    params (dict, optional): Solver parameters to set before
+	    	checking, e.g. `{'smt.relevancy': 2}`. Defaults to `None`.
 	
 	Returns:
 	    tuple[z3.CheckSatResult, Optional[z3.ModelRef]]: If
@@ -41,13 +49,19 @@ def check_sat(
 	    	with a corresponding model in the second position.
 	    	Otherwise, the second position is `None`.
 	"""
-	s = z3.Solver()
+	s = z3.Solver() if solver is None else solver
 	if timeout is not None:
 		s.set(timeout=int(timeout*1000))
+	if params is not None:
+		for k, v in params.items():
+			s.set(k, v)
+	s.push()
 	for p in ps:
 		s.add(p)
 	res = s.check()
-	return (res, s.model() if res == z3.sat else None)
+	model = s.model() if res == z3.sat else None
+	s.pop()
+	return (res, model)
 
 @simplify
 def term_enc(e: tn.Term) -> z3.IntNumRef:
@@ -118,6 +132,93 @@ def fmla_enc(p: tn.Formula) -> z3.BoolRef:
                 f"fmla_enc got {type(p)} ({p}), not Formula"
             )
 
+def try_term_eval(e: tn.Term) -> Optional[int]:
+    """
+    Evaluate a tinyscript term that does not depend on the state
+    
+    Args:
+        e (tn.Term): Term to evaluate
+    
+    Returns:
+        Optional[int]: Value of the term, or `None` if it
+        	mentions a variable
+    
+    Raises:
+        TypeError: If the argument isn't a valid 
+        	tinyscript term.
+    """
+    match e:
+        case tn.Const(val):
+            return val
+        case tn.Var(id):
+            return None
+        case tn.Sum(left, right) | tn.Difference(left, right) | tn.Product(left, right):
+            l, r = try_term_eval(left), try_term_eval(right)
+            if l is None or r is None:
+                return None
+            match e:
+                case tn.Sum():
+                    return l + r
+                case tn.Difference():
+                    return l - r
+                case tn.Product():
+                    return l * r
+        case _:
+            raise TypeError(
+                f"try_term_eval got {type(e)} ({e}), not Term"
+            )
+
+
+def try_eval(p: tn.Formula) -> Optional[bool]:
+    """
+    Evaluate a tinyscript formula that does not depend on the state.
+    Connectives are decided as soon as one operand determines them,
+    e.g. `false && q` is `False` for any `q`.
+    
+    Args:
+        p (tn.Formula): Formula to evaluate
+    
+    Returns:
+        Optional[bool]: Truth value of the formula, or `None` if it
+        	depends on the values of variables
+    
+    Raises:
+        TypeError: If the argument isn't a valid 
+        	tinyscript formula.
+    """
+    match p:
+        case tn.TrueC():
+            return True
+        case tn.FalseC():
+            return False
+        case tn.NotF(q):
+            v = try_eval(q)
+            return None if v is None else not v
+        case tn.AndF(p, q):
+            l, r = try_eval(p), try_eval(q)
+            if l is False or r is False:
+                return False
+            return True if l and r else None
+        case tn.OrF(p, q):
+            l, r = try_eval(p), try_eval(q)
+            if l is True or r is True:
+                return True
+            return False if l is False and r is False else None
+        case tn.ImpliesF(p, q):
+            l, r = try_eval(p), try_eval(q)
+            if l is False or r is True:
+                return True
+            return False if l is True and r is False else None
+        case tn.EqF(left, right) | tn.LtF(left, right):
+            l, r = try_term_eval(left), try_term_eval(right)
+            if l is None or r is None:
+                return None
+            return l == r if isinstance(p, tn.EqF) else l < r
+        case _:
+            raise TypeError(
+                f"try_eval got {type(p)} ({p}), not Formula"
+            )
+
 def term_stringify(e: tn.Term) -> str:
     """
     Pretty-print a tinyscript term